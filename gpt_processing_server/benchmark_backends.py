@@ -0,0 +1,107 @@
+"""
+Benchmark embedding backends and pick the fastest one that keeps retrieval quality.
+
+The fixture directory holds the images plus a `queries.json` file mapping each
+question to the image filenames that should be retrieved for it:
+
+    {"where is the water bottle?": ["kitchen_1.jpg", "kitchen_2.jpg"]}
+
+fixtures/backend_benchmark is a small synthetic set (coloured shapes) to check
+the setup; use captures from your own cameras to choose a backend.
+
+Usage:
+    python benchmark_backends.py fixtures/backend_benchmark --threads 4 --top-k 3
+    python benchmark_backends.py path/to/fixtures --threads 4 --tolerance 0.02
+"""
+import os
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+
+from embedding_backends import BACKENDS, get_backend
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+def load_fixtures(fixture_dir):
+    with open(os.path.join(fixture_dir, 'queries.json')) as f:
+        queries = json.load(f)
+    images = sorted(name for name in os.listdir(fixture_dir) if name.lower().endswith(IMAGE_EXTENSIONS))
+    if not images or not queries:
+        raise ValueError(f"No images or queries found in {fixture_dir}")
+    return images, queries
+
+def timed(fn, items, runs):
+    """Run fn(items) `runs` times and return (last result, best seconds per item)."""
+    best = float('inf')
+    result = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn(items)
+        best = min(best, time.perf_counter() - start)
+    return result, best / len(items)
+
+def recall_at_k(text_vectors, image_vectors, images, queries, top_k):
+    scores = text_vectors @ image_vectors.T
+    hits = 0
+    total = 0
+    for row, relevant in zip(scores, queries.values()):
+        top = {images[i] for i in np.argsort(-row)[:top_k]}
+        hits += len(top & set(relevant))
+        total += min(len(relevant), top_k)
+    return hits / total if total else 0.0
+
+def benchmark_backend(name, fixture_dir, images, queries, args):
+    start = time.perf_counter()
+    backend = get_backend(name, num_threads=args.threads)
+    load_seconds = time.perf_counter() - start
+
+    paths = [os.path.join(fixture_dir, image) for image in images]
+    backend.embed_images(paths[:1])  # warm-up
+    image_vectors, image_seconds = timed(backend.embed_images, paths, args.runs)
+    text_vectors, text_seconds = timed(backend.embed_texts, list(queries), args.runs)
+
+    return {
+        'backend': name,
+        'load_s': load_seconds,
+        'image_ms': image_seconds * 1000,
+        'text_ms': text_seconds * 1000,
+        'recall': recall_at_k(text_vectors, image_vectors, images, queries, args.top_k),
+        'image_vectors': image_vectors,
+    }
+
+def pick_backend(results, tolerance):
+    """Return the fastest result whose recall is within `tolerance` of the reference."""
+    reference = next(r for r in results if r['backend'] == 'reference')
+    eligible = [r for r in results if r['recall'] >= reference['recall'] - tolerance]
+    return min(eligible, key=lambda r: r['image_ms'] + r['text_ms'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare embedding backend speed and retrieval quality.")
+    parser.add_argument("fixture_dir", help="Directory with fixture images and queries.json")
+    parser.add_argument("--backends", nargs='+', default=list(BACKENDS), choices=list(BACKENDS), help="Backends to compare")
+    parser.add_argument("--threads", type=int, default=0, help="Intra-op threads (0 keeps the torch default)")
+    parser.add_argument("--runs", type=int, default=3, help="Timed runs per backend; the best run is reported")
+    parser.add_argument("--top-k", type=int, default=5, help="k for recall@k")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="Allowed recall drop against the reference backend")
+    args = parser.parse_args()
+
+    images, queries = load_fixtures(args.fixture_dir)
+    backends = ['reference'] + [name for name in args.backends if name != 'reference']
+    results = [benchmark_backend(name, args.fixture_dir, images, queries, args) for name in backends]
+
+    reference_vectors = results[0]['image_vectors']
+    print(f"{'backend':<12}{'load s':>9}{'image ms':>10}{'text ms':>9}{'recall@' + str(args.top_k):>11}{'cos vs ref':>12}")
+    for r in results:
+        agreement = float(np.mean(np.sum(r['image_vectors'] * reference_vectors, axis=1)))
+        print(f"{r['backend']:<12}{r['load_s']:>9.2f}{r['image_ms']:>10.1f}{r['text_ms']:>9.1f}{r['recall']:>11.3f}{agreement:>12.4f}")
+
+    best = pick_backend(results, args.tolerance)
+    print(f"\nSelected backend: {best['backend']} (set EMBEDDING_BACKEND={best['backend']})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Measure server startup time.
+
+Starts the server with uvicorn and reports how long it takes until `/api/ping`
+answers (upload path available) and until `/api/ready` reports the embedding
+backend loaded and warmed up. Also reports how long `import main` takes on its own.
+
+Usage:
+    python benchmark_startup.py --port 8001 --runs 3
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import subprocess
+
+import requests
+from requests.exceptions import RequestException
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def server_env():
+    env = dict(os.environ)
+    env.setdefault('OPENAI_API_KEY', 'benchmark')
+    return env
+
+def measure_import():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import main'], cwd=SERVER_DIR, env=server_env(), check=True)
+    return time.perf_counter() - start
+
+def wait_for(url, start, timeout):
+    while time.perf_counter() - start < timeout:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return time.perf_counter() - start
+        except RequestException:
+            pass
+        time.sleep(0.05)
+    raise TimeoutError(f"{url} not available after {timeout}s")
+
+def measure_startup(port, timeout):
+    base_url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port)],
+        cwd=SERVER_DIR, env=server_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        ping_seconds = wait_for(f"{base_url}/api/ping", start, timeout)
+        ready_seconds = wait_for(f"{base_url}/api/ready", start, timeout)
+        return ping_seconds, ready_seconds
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark server startup time.")
+    parser.add_argument("--port", type=int, default=8001, help="Port to start the server on")
+    parser.add_argument("--runs", type=int, default=3, help="Number of startups to measure")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for readiness")
+    args = parser.parse_args()
+
+    print(f"{'run':<5}{'import s':>10}{'ping s':>10}{'ready s':>10}")
+    for run in range(1, args.runs + 1):
+        import_seconds = measure_import()
+        ping_seconds, ready_seconds = measure_startup(args.port, args.timeout)
+        print(f"{run:<5}{import_seconds:>10.2f}{ping_seconds:>10.2f}{ready_seconds:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+import logging
+
+import numpy as np
+import torch
+import clip
+from PIL import Image
+
+DEFAULT_CLIP_MODEL = 'ViT-B/32'
+
+class EmbeddingBackend:
+    """
+    Base class for CLIP embedding backends.
+
+    Subclasses load a model in `_load_model` and may override `_encode_text` /
+    `_encode_image` to run it differently. All vectors are L2-normalised float32.
+    """
+    name = 'base'
+
+    def __init__(self, model_name: str = DEFAULT_CLIP_MODEL, num_threads: int = 0, device: str = None):
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        self.model_name = model_name
+        self.num_threads = torch.get_num_threads()
+        self.device = device or self._default_device()
+        self.model, self.preprocess = self._load_model()
+        logging.info(f"Loaded {self.name} embedding backend ({model_name}) on {self.device} with {self.num_threads} threads")
+
+    def _default_device(self) -> str:
+        return "cuda" if torch.cuda.is_available() else "cpu"
+
+    def _load_model(self):
+        model, preprocess = clip.load(self.model_name, device=self.device)
+        model.eval()
+        return model, preprocess
+
+    def _encode_text(self, tokens):
+        return self.model.encode_text(tokens)
+
+    def _encode_image(self, pixels):
+        return self.model.encode_image(pixels)
+
+    def _load_image(self, image):
+        if isinstance(image, Image.Image):
+            return self.preprocess(image)
+        with Image.open(image) as img:
+            return self.preprocess(img)
+
+    @staticmethod
+    def _normalize(features) -> np.ndarray:
+        features = features.float()
+        features /= features.norm(dim=-1, keepdim=True)
+        return features.cpu().numpy()
+
+    def embed_texts(self, texts: list) -> np.ndarray:
+        with torch.no_grad():
+            tokens = clip.tokenize(texts, truncate=True).to(self.device)
+            return self._normalize(self._encode_text(tokens))
+
+    def embed_images(self, images: list) -> np.ndarray:
+        """Embed a batch of image paths or PIL images."""
+        with torch.no_grad():
+            pixels = torch.stack([self._load_image(image) for image in images]).to(self.device)
+            return self._normalize(self._encode_image(pixels))
+
+    def warm_up(self):
+        """Run one text and one image through the model so the first real request is not slow."""
+        self.embed_texts(["warm up"])
+        self.embed_images([Image.new("RGB", (224, 224))])
+
+class ClipBackend(EmbeddingBackend):
+    """The stock CLIP model, unchanged. Used as the quality reference."""
+    name = 'reference'
+
+class QuantizedClipBackend(EmbeddingBackend):
+    """CLIP with int8 dynamically quantized linear layers, CPU only."""
+    name = 'quantized'
+
+    def _default_device(self) -> str:
+        return "cpu"
+
+    def _load_model(self):
+        model, preprocess = super()._load_model()
+        # The attention pooling of the ResNet models reads the projection biases directly, so it stays in float
+        layers = {
+            name for name, module in model.named_modules()
+            if type(module) is torch.nn.Linear and not name.startswith('visual.attnpool')
+        }
+        model = torch.quantization.quantize_dynamic(model.float(), layers, dtype=torch.qint8)
+        return model, preprocess
+
+class TracedClipBackend(EmbeddingBackend):
+    """CLIP traced with TorchScript, CPU only."""
+    name = 'traced'
+
+    def _default_device(self) -> str:
+        return "cpu"
+
+    def _load_model(self):
+        model, preprocess = super()._load_model()
+        resolution = model.visual.input_resolution
+        example_pixels = torch.zeros(1, 3, resolution, resolution, device=self.device)
+        example_tokens = clip.tokenize(["a photo"]).to(self.device)
+        with torch.no_grad():
+            traced = torch.jit.trace_module(
+                model.float(),
+                {"encode_image": example_pixels, "encode_text": example_tokens},
+                check_trace=False
+            )
+        return traced, preprocess
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (ClipBackend, QuantizedClipBackend, TracedClipBackend)
+}
+
+def get_backend(name: str = None, model_name: str = None, num_threads: int = None, **kwargs) -> EmbeddingBackend:
+    """
+    Create an embedding backend by name.
+
+    Arguments left as None are read from EMBEDDING_BACKEND, CLIP_MODEL and
+    EMBEDDING_THREADS when the backend is created, not when this module is imported.
+
+    :param name: one of BACKENDS ('reference', 'quantized', 'traced')
+    :param model_name: CLIP model name, e.g. 'ViT-B/32'
+    :param num_threads: intra-op threads (0 keeps the torch default)
+    :param kwargs: passed to the backend constructor (device)
+    :return: loaded backend
+    """
+    name = name or os.getenv('EMBEDDING_BACKEND', 'reference')
+    model_name = model_name or os.getenv('CLIP_MODEL', DEFAULT_CLIP_MODEL)
+    num_threads = int(os.getenv('EMBEDDING_THREADS', '0')) if num_threads is None else num_threads
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{name}'. Expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name](model_name=model_name, num_threads=num_threads, **kwargs)
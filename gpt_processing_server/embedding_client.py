@@ -0,0 +1,125 @@
+"""
+Client side of the shared embedding service (see embedding_service.py).
+
+Messages on the socket are frames of `>II` (header length, payload length),
+a JSON header and a binary payload. Requests carry
+`{"id", "kind": "text" | "image" | "ping", "items": [...]}` with an empty payload;
+responses carry `{"id", "shape": [n, dim]}` with the float32 vectors as payload,
+or `{"id", "error"}`.
+"""
+import json
+import struct
+import asyncio
+import logging
+import itertools
+
+import numpy as np
+
+FRAME_HEADER = struct.Struct('>II')
+
+async def read_frame(reader):
+    header_len, payload_len = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    header = json.loads(await reader.readexactly(header_len))
+    payload = await reader.readexactly(payload_len) if payload_len else b''
+    return header, payload
+
+def write_frame(writer, header, payload=b''):
+    header_bytes = json.dumps(header).encode()
+    writer.write(FRAME_HEADER.pack(len(header_bytes), len(payload)) + header_bytes + payload)
+
+class EmbeddingServiceError(Exception):
+    pass
+
+class LocalEmbeddingClient:
+    """Runs a backend in this process behind the same async interface as EmbeddingClient."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+
+    async def embed_texts(self, texts: list) -> np.ndarray:
+        return await asyncio.to_thread(self.backend.embed_texts, texts)
+
+    async def embed_images(self, images: list) -> np.ndarray:
+        return await asyncio.to_thread(self.backend.embed_images, images)
+
+class EmbeddingClient:
+    """
+    Connection to the shared embedding service over a Unix socket.
+
+    Requests from concurrent callers are multiplexed on one connection; the
+    service coalesces them (and those of other workers) into batches.
+    """
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.name = None
+        self._ids = itertools.count()
+        self._pending = {}
+        self._writer = None
+        self._reader_task = None
+        self._connect_lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, socket_path: str, retry_interval: float = 1.0):
+        """Connect to the service, waiting until it is up and its model is loaded."""
+        client = cls(socket_path)
+        while True:
+            try:
+                info = await client._request('ping', [])
+                client.name = info['backend']
+                return client
+            except (OSError, EmbeddingServiceError) as e:
+                logging.info(f"Waiting for embedding service at {socket_path}: {e}")
+                await asyncio.sleep(retry_interval)
+
+    async def _ensure_connected(self):
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return
+            reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+            self._reader_task = asyncio.create_task(self._read_responses(reader, self._writer))
+
+    async def _read_responses(self, reader, writer):
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                future = self._pending.pop(header['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in header:
+                    future.set_exception(EmbeddingServiceError(header['error']))
+                elif 'shape' in header:
+                    future.set_result(np.frombuffer(payload, dtype=np.float32).reshape(header['shape']))
+                else:
+                    future.set_result(header)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            logging.warning(f"Embedding service connection lost: {e}")
+        finally:
+            writer.close()
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(EmbeddingServiceError("Embedding service connection lost"))
+            self._pending.clear()
+
+    async def _request(self, kind, items):
+        await self._ensure_connected()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        write_frame(self._writer, {'id': request_id, 'kind': kind, 'items': items})
+        await self._writer.drain()
+        return await future
+
+    async def embed_texts(self, texts: list) -> np.ndarray:
+        return await self._request('text', texts)
+
+    async def embed_images(self, images: list) -> np.ndarray:
+        """Embed images by path. Paths are resolved by the service process."""
+        return await self._request('image', [str(image) for image in images])
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            await self._reader_task
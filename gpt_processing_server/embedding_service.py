@@ -0,0 +1,183 @@
+"""
+Shared embedding service.
+
+Holds the single CLIP model for a deployment and serves text and image
+embedding to the web workers over a Unix socket (protocol in embedding_client.py).
+Requests from all connections are coalesced into batches. The service also owns
+the image_data_insert listener, so each uploaded image is embedded exactly once
+no matter how many web workers run.
+
+Usage (from the gpt_processing_server directory, so image paths resolve):
+    python embedding_service.py --socket /tmp/find_my_goods_embedding.sock
+    EMBEDDING_SERVICE_SOCKET=/tmp/find_my_goods_embedding.sock uvicorn main:app --workers 4
+"""
+import os
+import time
+import asyncio
+import logging
+import argparse
+
+import asyncpg
+import numpy as np
+from dotenv import load_dotenv
+
+# Load .env before the local modules, which read their settings from the environment
+load_dotenv()
+
+from embedding_client import read_frame, write_frame
+from notifications import listen_to_notifications
+
+DATABASE_URL = os.getenv('DATABASE_URL', 'dbname=pgdatabase user=pguser password=pgpassword host=localhost')
+EMBEDDING_SERVICE_SOCKET = os.getenv('EMBEDDING_SERVICE_SOCKET') or '/tmp/find_my_goods_embedding.sock'
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class Batcher:
+    """
+    Coalesces embedding requests into batches.
+
+    A batch is flushed when it holds `max_batch` items or `max_wait` seconds
+    after its first request arrived, whichever comes first.
+    """
+
+    def __init__(self, embed, max_batch: int, max_wait: float):
+        self.embed = embed
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = None
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        # Created on first use: before Python 3.10 a queue binds to the event loop current at construction
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def submit(self, items: list) -> np.ndarray:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((items, future))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    async def _run_batch(self, batch):
+        items = [item for request_items, _ in batch for item in request_items]
+        try:
+            vectors = await asyncio.to_thread(self.embed, items)
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            # One bad item (e.g. an unreadable image) must not fail the other requests
+            logging.warning(f"Batch of {len(items)} failed ({e}), retrying requests individually")
+            for request in batch:
+                await self._run_batch([request])
+            return
+        offset = 0
+        for request_items, future in batch:
+            if not future.done():  # the requesting connection may have gone away
+                future.set_result(vectors[offset:offset + len(request_items)])
+            offset += len(request_items)
+
+    async def run(self):
+        while True:
+            batch = await self._next_batch()
+            await self._run_batch(batch)
+
+class EmbeddingService:
+    def __init__(self, backend, max_batch: int, max_wait: float):
+        self.backend = backend
+        self.batchers = {
+            'text': Batcher(backend.embed_texts, max_batch, max_wait),
+            'image': Batcher(backend.embed_images, max_batch, max_wait),
+        }
+
+    async def vectorize_image(self, image_path):
+        try:
+            vectors = await self.batchers['image'].submit([image_path])
+            return vectors[0].tolist()
+        except Exception as e:
+            logging.error(f"Error in vectorize_image: {e}")
+            return []
+
+    async def _respond(self, writer, request):
+        try:
+            if request['kind'] == 'ping':
+                write_frame(writer, {'id': request['id'], 'backend': self.backend.name})
+                return
+            if request['kind'] not in self.batchers:
+                raise ValueError(f"Unknown request kind: {request['kind']}")
+            vectors = await self.batchers[request['kind']].submit(request['items'])
+            vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+            write_frame(writer, {'id': request['id'], 'shape': list(vectors.shape)}, vectors.tobytes())
+        except Exception as e:
+            write_frame(writer, {'id': request['id'], 'error': str(e)})
+
+    async def handle_connection(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                request, _ = await read_frame(reader)
+                task = asyncio.create_task(self._respond(writer, request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+async def serve(args):
+    # torch and CLIP are imported here so that the batching code can be imported without them
+    from embedding_backends import get_backend
+
+    backend = await asyncio.to_thread(get_backend, args.backend, model_name=args.model, num_threads=args.threads)
+    await asyncio.to_thread(backend.warm_up)
+    service = EmbeddingService(backend, args.max_batch, args.max_wait_ms / 1000)
+    batch_tasks = [asyncio.create_task(batcher.run()) for batcher in service.batchers.values()]
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = await asyncio.start_unix_server(service.handle_connection, path=args.socket)
+    logging.info(f"Embedding service ({backend.name}) listening on {args.socket}")
+
+    tasks = batch_tasks + [asyncio.create_task(server.serve_forever())]
+    if not args.no_listen:
+        db_pool = await asyncpg.create_pool(DATABASE_URL)
+        tasks.append(asyncio.create_task(listen_to_notifications(DATABASE_URL, db_pool, service.vectorize_image)))
+    await asyncio.gather(*tasks)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the shared CLIP embedding service.")
+    parser.add_argument("--socket", default=EMBEDDING_SERVICE_SOCKET, help="Unix socket path to listen on")
+    parser.add_argument("--backend", default=os.getenv('EMBEDDING_BACKEND', 'reference'), help="Embedding backend name")
+    parser.add_argument("--model", default=os.getenv('CLIP_MODEL', 'ViT-B/32'), help="CLIP model to embed with")
+    parser.add_argument("--threads", type=int, default=int(os.getenv('EMBEDDING_THREADS', '0')), help="Intra-op threads (0 keeps the torch default)")
+    parser.add_argument("--max-batch", type=int, default=32, help="Maximum items per model batch")
+    parser.add_argument("--max-wait-ms", type=float, default=10, help="Maximum time to wait for a batch to fill")
+    parser.add_argument("--no-listen", action="store_true", help="Do not embed new uploads from image_data_insert notifications")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        logging.info("Embedding service stopped")
+
+if __name__ == "__main__":
+    main()
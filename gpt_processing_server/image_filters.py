@@ -0,0 +1,42 @@
+from datetime import datetime, timezone
+
+def parse_timestamp(value: str) -> datetime:
+    """
+    Parse an ISO timestamp from the command line, treating naive values as UTC.
+
+    :param value: ISO format string, e.g. '2024-06-01' or '2024-06-01T12:00:00+02:00'
+    :return: timezone-aware datetime in UTC
+    """
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+def build_image_filter(statuses=None, since=None, until=None, locations=None, first_param=1):
+    """
+    Build a WHERE clause selecting image_data rows.
+
+    :param statuses: list of statuses to include, e.g. ['pending']
+    :param since: include rows with timestamp >= since
+    :param until: include rows with timestamp < until
+    :param locations: list of locations to include
+    :param first_param: number of the first positional query parameter
+    :return: (sql condition, list of query arguments)
+    """
+    clauses = []
+    args = []
+
+    def add(clause, value):
+        args.append(value)
+        clauses.append(clause.format(f"${first_param + len(args) - 1}"))
+
+    if statuses:
+        add("status = ANY({})", list(statuses))
+    if since:
+        add("timestamp >= {}", since)
+    if until:
+        add("timestamp < {}", until)
+    if locations:
+        add("location = ANY({})", list(locations))
+
+    return (" AND ".join(clauses) or "TRUE"), args
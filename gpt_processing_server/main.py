@@ -1,7 +1,9 @@
 import os
 import base64
+import mimetypes
 import json
 import uuid
+import time
 import asyncio
 from typing import List, Optional
 from functools import lru_cache
@@ -10,15 +12,15 @@ from datetime import datetime, timezone
 import aiohttp
 import asyncpg
 import logging
-import torch
-import clip
-from PIL import Image
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query, Depends
 from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from langdetect import detect, LangDetectException, DetectorFactory
 
+from embedding_client import EmbeddingClient, LocalEmbeddingClient
+from notifications import listen_to_notifications
+
 load_dotenv()
 
 API_KEY = os.getenv('OPENAI_API_KEY')
@@ -27,23 +29,80 @@ if not API_KEY:
 
 DATABASE_URL = os.getenv('DATABASE_URL', 'dbname=pgdatabase user=pguser password=pgpassword host=localhost')
 PHOTOS_DIR = 'photos'
+# When set, embeddings come from the shared embedding service instead of a model in this process
+EMBEDDING_SERVICE_SOCKET = os.getenv('EMBEDDING_SERVICE_SOCKET')
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 app = FastAPI()
 
-# Load CLIP model
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device=device)
+def _load_embedding_backend():
+    # torch and CLIP are imported here so that importing this module stays fast
+    from embedding_backends import get_backend
+
+    backend = get_backend()
+    backend.warm_up()
+    return backend
+
+async def load_embedding_backend():
+    """Load and warm up the CLIP embedding backend (or connect to the embedding service) in the background."""
+    start = time.perf_counter()
+    try:
+        if EMBEDDING_SERVICE_SOCKET:
+            app.state.embedding_backend = await EmbeddingClient.connect(EMBEDDING_SERVICE_SOCKET)
+        else:
+            app.state.embedding_backend = LocalEmbeddingClient(await asyncio.to_thread(_load_embedding_backend))
+        logging.info(f"Embedding backend ready in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        app.state.embedding_error = str(e)
+        logging.error(f"Failed to load embedding backend: {e}", exc_info=True)
+    finally:
+        app.state.embedding_ready.set()
+
+async def get_embedding_backend():
+    await app.state.embedding_ready.wait()
+    if app.state.embedding_backend is None:
+        raise RuntimeError(f"Embedding backend unavailable: {app.state.embedding_error}")
+    return app.state.embedding_backend
 
 # Use asyncpg for asynchronous database operations
 async def get_db_pool():
     return await asyncpg.create_pool(DATABASE_URL)
 
+async def get_vector_dim(conn, table='image_data') -> Optional[int]:
+    """Return the dimension of `table`.vector, which changes when reembed.py migrates to another model."""
+    # pgvector stores the dimension as the column's type modifier; None when the table does not exist
+    return await conn.fetchval("""
+        SELECT atttypmod FROM pg_attribute
+        WHERE attrelid = to_regclass($1) AND attname = 'vector' AND NOT attisdropped
+    """, table)
+
+async def get_search_tables(conn) -> List[str]:
+    """
+    Return the tables searched for relevant photos.
+
+    Rows moved to image_data_archive by retention.py stay searchable, unless the
+    archive still holds vectors of another model after a migration of image_data.
+    """
+    tables = ['image_data']
+    archive_dim = await get_vector_dim(conn, 'image_data_archive')
+    if archive_dim is not None:
+        if archive_dim == await get_vector_dim(conn):
+            tables.append('image_data_archive')
+        else:
+            logging.warning("image_data_archive has vectors of another model and is not searched; re-embed it with reembed.py --table image_data_archive")
+    return tables
+
 @app.on_event("startup")
 async def startup_event():
+    app.state.embedding_backend = None
+    app.state.embedding_error = None
+    app.state.embedding_ready = asyncio.Event()
+    app.state.embedding_task = asyncio.create_task(load_embedding_backend())
     app.state.db_pool = await get_db_pool()
+    async with app.state.db_pool.acquire() as conn:
+        app.state.vector_dim = await get_vector_dim(conn)
 
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -100,7 +159,6 @@ async def upload_photo(
         buffer.write(content)
 
     image_id = str(uuid.uuid4())
-    zero_vector = [0.0] * 512  # CLIP uses 512-dimensional vectors
 
     # Convert timestamp string to UTC datetime object
     try:
@@ -115,11 +173,20 @@ async def upload_photo(
     # Use the current time for both timestamp and created_at
     current_time = datetime.now(timezone.utc)
     
+    insert_query = """
+        INSERT INTO image_data (image_id, s3_url, status, timestamp, location, vector, created_at)
+        VALUES ($1, $2, 'pending', $3, $4, $5, $3)
+    """
     async with app.state.db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO image_data (image_id, s3_url, status, timestamp, location, vector, created_at)
-            VALUES ($1, $2, 'pending', $3, $4, $5, $3)
-        """, image_id, save_path, current_time, location, json.dumps(zero_vector))
+        try:
+            zero_vector = [0.0] * app.state.vector_dim
+            await conn.execute(insert_query, image_id, save_path, current_time, location, json.dumps(zero_vector))
+        except asyncpg.DataError:
+            # The vector column was swapped to another dimension by a model migration
+            app.state.vector_dim = await get_vector_dim(conn)
+            logging.info(f"image_data.vector now has {app.state.vector_dim} dimensions")
+            zero_vector = [0.0] * app.state.vector_dim
+            await conn.execute(insert_query, image_id, save_path, current_time, location, json.dumps(zero_vector))
 
     return {"message": "File uploaded and queued successfully", "filename": filename}
 
@@ -149,6 +216,18 @@ def format_timestamp(timestamp: datetime) -> str:
     utc_timestamp = timestamp.astimezone(timezone.utc)
     return utc_timestamp.strftime("%Y-%m-%d %H:%M:%S")
 
+# Not in the default mimetypes table before Python 3.11
+mimetypes.add_type('image/webp', '.webp')
+
+def image_mime_type(image_path):
+    """
+    MIME type of a stored image, from its extension.
+
+    Uploads and the archival copies made by retention.py are not always JPEG.
+    """
+    mime_type, _ = mimetypes.guess_type(image_path)
+    return mime_type if mime_type and mime_type.startswith('image/') else 'image/jpeg'
+
 async def gpt4_visual_speak(image_metadata, question, language):
     try:
         sorted_metadata = sorted(image_metadata, key=lambda x: x['timestamp'])
@@ -159,7 +238,7 @@ async def gpt4_visual_speak(image_metadata, question, language):
             messages.append({
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{encoded_image}"
+                    "url": f"data:{image_mime_type(data['s3_url'])};base64,{encoded_image}"
                 }
             })
             formatted_timestamp = format_timestamp(data['timestamp'])
@@ -227,6 +306,60 @@ async def gpt4_visual_speak(image_metadata, question, language):
 async def ping_pong():
     return JSONResponse(content={"message": "pong"})
 
+@app.get("/api/ready")
+async def readiness():
+    if app.state.embedding_backend is not None:
+        return JSONResponse(content={"status": "ready", "backend": app.state.embedding_backend.name})
+    if app.state.embedding_error:
+        return JSONResponse(status_code=503, content={"status": "failed", "error": app.state.embedding_error})
+    return JSONResponse(status_code=503, content={"status": "loading"})
+
+@app.get("/api/export/vectors")
+async def export_vectors(
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    location: Optional[List[str]] = Query(None),
+    status: List[str] = Query(['completed']),
+    source: str = 'image_data',
+    batch_size: int = Query(10000, ge=1, le=100000)
+):
+    """Stream embeddings with image_id, timestamp and location as an Arrow IPC stream."""
+    # pyarrow is only needed here, so it is not imported at startup
+    from image_filters import parse_timestamp
+    from vector_export import ARROW_STREAM_MEDIA_TYPE, register_vector_codec, open_arrow_stream
+
+    try:
+        since_dt = parse_timestamp(since) if since else None
+        until_dt = parse_timestamp(until) if until else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid timestamp format. Expected ISO format.")
+
+    # A dedicated connection: the export holds it for its whole duration and changes its vector codec.
+    # The source is checked and the first batch read before responding, so failures get a proper status.
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await register_vector_codec(conn)
+        chunks = await open_arrow_stream(
+            conn, source=source, statuses=status, since=since_dt,
+            until=until_dt, locations=location, batch_size=batch_size
+        )
+    except ValueError as e:
+        await conn.close()
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        await conn.close()
+        logging.error(f"Error starting vector export: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Failed to start the export")
+
+    async def generate():
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await conn.close()
+
+    return StreamingResponse(generate(), media_type=ARROW_STREAM_MEDIA_TYPE)
+
 async def get_relevant_photos(question: str, max_images: int, db_pool):
     question_vector = await vectorize_text(question)
     
@@ -234,13 +367,15 @@ async def get_relevant_photos(question: str, max_images: int, db_pool):
         raise HTTPException(status_code=500, detail="Failed to vectorize the question")
     
     async with db_pool.acquire() as conn:
-        similar_images = await conn.fetch("""
-            SELECT s3_url, timestamp, location, vector <-> $1 AS distance
-            FROM image_data
-            WHERE status = 'completed'
-            ORDER BY distance
-            LIMIT $2
-        """, json.dumps(question_vector), max_images)
+        # Each table is searched through its own vector index before the results are merged
+        query = " UNION ALL ".join(f"""
+            (SELECT s3_url, timestamp, location, vector <-> $1 AS distance
+             FROM {table}
+             WHERE status = 'completed'
+             ORDER BY distance
+             LIMIT $2)
+        """ for table in await get_search_tables(conn))
+        similar_images = await conn.fetch(f"{query} ORDER BY distance LIMIT $2", json.dumps(question_vector), max_images)
         
         if not similar_images:
             logging.info(f"No relevant images found!")
@@ -268,73 +403,29 @@ async def ask_gpt4_visual_search(request: QuestionRequest):
 
 async def vectorize_text(text):
     try:
-        with torch.no_grad():
-            text_inputs = clip.tokenize([text]).to(device)
-            text_features = model.encode_text(text_inputs)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
-            return text_features.cpu().numpy()[0].tolist()
+        embedding_backend = await get_embedding_backend()
+        text_features = await embedding_backend.embed_texts([text])
+        return text_features[0].tolist()
     except Exception as e:
         logging.error(f"Error in vectorize_text: {e}")
         return []
 
 async def vectorize_image(image_path):
     try:
-        image = preprocess(Image.open(image_path)).unsqueeze(0).to(device)
-        with torch.no_grad():
-            image_features = model.encode_image(image)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
-            return image_features.cpu().numpy()[0].tolist()
+        embedding_backend = await get_embedding_backend()
+        image_features = await embedding_backend.embed_images([image_path])
+        return image_features[0].tolist()
     except Exception as e:
         logging.error(f"Error in vectorize_image: {e}")
         return []
     
-async def handle_notification(conn, pid, channel, payload):
-    try:
-        logging.info(f"Received notification: {payload}")
-        payload_data = json.loads(payload)
-        image_id = payload_data.get('image_id')
-
-        logging.info(f"Processing image_id: {image_id}")
-
-        image_data = await conn.fetchrow(
-            "SELECT s3_url FROM image_data WHERE image_id = $1",
-            image_id
-        )
-        if not image_data:
-            logging.warning(f"No image data found for image_id: {image_id}")
-            return
-
-        s3_url = image_data['s3_url']
-        logging.info(f"Vectorizing image: {s3_url}")
-
-        vector = await vectorize_image(s3_url)
-
-        if not vector:
-            logging.error(f"Failed to vectorize image: {s3_url}")
-            return
-
-        logging.info(f"Updating database with vector for image_id: {image_id}")
-        async with conn.transaction():
-            await conn.execute("""
-                UPDATE image_data
-                SET vector = $1, status = 'completed'
-                WHERE image_id = $2
-            """, json.dumps(vector), image_id)
-            
-        logging.info(f"Image processed successfully for image_id: {image_id}, s3_url: {s3_url}")
-    except Exception as e:
-        logging.error(f"Error handling notification for image_id: {image_id}: {str(e)}")
-
 @app.on_event("startup")
 async def startup():
-    async def listen_to_notifications():
-        conn = await asyncpg.connect(DATABASE_URL)
-        await conn.add_listener('image_data_insert', handle_notification)
-        logging.info("Started listening for image_data_insert notifications")
-        while True:
-            await asyncio.sleep(3600)   # Keep the connection alive
-
-    asyncio.create_task(listen_to_notifications())
+    # With a shared embedding service, the service listens for new images instead
+    if not EMBEDDING_SERVICE_SOCKET:
+        app.state.listener_task = asyncio.create_task(
+            listen_to_notifications(DATABASE_URL, app.state.db_pool, vectorize_image)
+        )
 
 if __name__ == "__main__":
     import uvicorn
@@ -342,4 +433,4 @@ if __name__ == "__main__":
     if not os.path.exists(PHOTOS_DIR):
         os.makedirs(PHOTOS_DIR)
 
-    uvicorn.run("app:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
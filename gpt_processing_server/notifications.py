@@ -0,0 +1,60 @@
+import json
+import asyncio
+import logging
+from functools import partial
+
+import asyncpg
+
+async def handle_notification(vectorize_image, db_pool, conn, pid, channel, payload):
+    """
+    Embed a newly inserted image and mark it completed.
+
+    Queries run on `db_pool` rather than the listening connection, so several
+    notifications can be processed (and batched by the embedder) concurrently.
+    """
+    image_id = None
+    try:
+        logging.info(f"Received notification: {payload}")
+        payload_data = json.loads(payload)
+        image_id = payload_data.get('image_id')
+
+        logging.info(f"Processing image_id: {image_id}")
+
+        async with db_pool.acquire() as db_conn:
+            image_data = await db_conn.fetchrow(
+                "SELECT s3_url FROM image_data WHERE image_id = $1",
+                image_id
+            )
+        if not image_data:
+            logging.warning(f"No image data found for image_id: {image_id}")
+            return
+
+        s3_url = image_data['s3_url']
+        logging.info(f"Vectorizing image: {s3_url}")
+
+        vector = await vectorize_image(s3_url)
+
+        if not vector:
+            logging.error(f"Failed to vectorize image: {s3_url}")
+            return
+
+        logging.info(f"Updating database with vector for image_id: {image_id}")
+        async with db_pool.acquire() as db_conn:
+            async with db_conn.transaction():
+                await db_conn.execute("""
+                    UPDATE image_data
+                    SET vector = $1, status = 'completed'
+                    WHERE image_id = $2
+                """, json.dumps(vector), image_id)
+
+        logging.info(f"Image processed successfully for image_id: {image_id}, s3_url: {s3_url}")
+    except Exception as e:
+        logging.error(f"Error handling notification for image_id: {image_id}: {str(e)}")
+
+async def listen_to_notifications(database_url, db_pool, vectorize_image):
+    """Embed every image announced on the image_data_insert channel. Runs forever."""
+    conn = await asyncpg.connect(database_url)
+    await conn.add_listener('image_data_insert', partial(handle_notification, vectorize_image, db_pool))
+    logging.info("Started listening for image_data_insert notifications")
+    while True:
+        await asyncio.sleep(3600)   # Keep the connection alive
@@ -0,0 +1,341 @@
+"""
+Bulk re-embedding and model migration.
+
+Re-embeds the selected images with a pool of worker processes and writes the
+vectors into a shadow column (`vector_next` by default), so queries keep using
+`vector` while the job runs. Progress is checkpointed after every written
+batch; running the same command again resumes where it stopped.
+
+With --cutover, once every selected row is done the shadow column replaces the
+live vectors in a single transaction:
+
+- for a full-corpus job (no filters) the columns are swapped, so the new vectors
+  may have a different dimension (e.g. when switching CLIP models). The vector
+  index of the shadow column is built beforehand, one partition at a time with
+  CREATE INDEX CONCURRENTLY, so uploads and embedding updates are not blocked;
+- for a filtered job the shadow vectors are copied over the selected rows.
+
+Usage:
+    python reembed.py --status pending --workers 4
+    python reembed.py --model ViT-L/14 --workers 8 --max-rows-per-sec 200 --cutover
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import asyncpg
+from dotenv import load_dotenv
+
+from image_filters import build_image_filter, parse_timestamp
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL', 'dbname=pgdatabase user=pguser password=pgpassword host=localhost')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+_worker_backend = None
+
+def _init_worker(backend_name, model_name, num_threads):
+    global _worker_backend
+    from embedding_backends import get_backend
+
+    _worker_backend = get_backend(backend_name, model_name=model_name, num_threads=num_threads)
+
+def _embed_batch(paths):
+    """Embed a batch of image paths in a worker. Returns one vector (list) or None per path."""
+    try:
+        return _worker_backend.embed_images(paths).tolist()
+    except Exception:
+        # Retry one by one so a single unreadable image does not fail the whole batch
+        vectors = []
+        for path in paths:
+            try:
+                vectors.append(_worker_backend.embed_images([path])[0].tolist())
+            except Exception as e:
+                logging.error(f"Failed to vectorize image {path}: {e}")
+                vectors.append(None)
+        return vectors
+
+class Throttle:
+    """Limits the average write rate to `rows_per_sec` (0 disables throttling)."""
+
+    def __init__(self, rows_per_sec: float):
+        self.rows_per_sec = rows_per_sec
+        self.start = time.monotonic()
+        self.rows = 0
+
+    async def wait(self, rows: int):
+        self.rows += rows
+        if self.rows_per_sec <= 0:
+            return
+        ahead = self.rows / self.rows_per_sec - (time.monotonic() - self.start)
+        if ahead > 0:
+            await asyncio.sleep(ahead)
+
+class Checkpoint:
+    """Progress of a re-embedding job, stored as JSON so the job can resume."""
+
+    def __init__(self, path: str, job: dict):
+        self.path = path
+        self.job = job
+        self.last_id = 0
+        self.completed = 0
+        self.failed = []
+        self.resumed = os.path.exists(path)
+        if self.resumed:
+            with open(path) as f:
+                state = json.load(f)
+            if state['job'] != job:
+                raise ValueError(f"Checkpoint {path} belongs to a different job: {state['job']}")
+            self.last_id = state['last_id']
+            self.completed = state['completed']
+            self.failed = state['failed']
+            logging.info(f"Resuming from checkpoint {path}: {self.completed} rows done, last id {self.last_id}")
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'job': self.job, 'last_id': self.last_id, 'completed': self.completed, 'failed': self.failed}, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# Name of the live ivfflat index of each table that can be re-embedded
+VECTOR_INDEXES = {'image_data': 'idx_vector', 'image_data_archive': 'idx_archive_vector'}
+# Views selecting the vector column have to be recreated when the column is swapped
+DEPENDENT_VIEWS = ('image_data_all',)
+
+async def ensure_shadow_column(conn, table, column, dim):
+    await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} vector({dim})")
+
+async def fetch_batches(conn, table, condition, args, last_id, batch_size):
+    """Yield batches of (id, s3_url) rows after `last_id`, in id order."""
+    id_param = len(args) + 1
+    query = f"""
+        SELECT id, s3_url FROM {table}
+        WHERE {condition} AND id > ${id_param}
+        ORDER BY id
+        LIMIT ${id_param + 1}
+    """
+    while True:
+        rows = await conn.fetch(query, *args, last_id, batch_size)
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1]['id']
+
+async def write_batch(conn, table, column, rows, vectors, checkpoint):
+    updates = []
+    for row, vector in zip(rows, vectors):
+        if vector is None:
+            checkpoint.failed.append(row['id'])
+        else:
+            updates.append((json.dumps(vector), row['id']))
+
+    if updates:
+        if checkpoint.completed == 0:
+            await ensure_shadow_column(conn, table, column, len(json.loads(updates[0][0])))
+        await conn.executemany(f"UPDATE {table} SET {column} = $1 WHERE id = $2", updates)
+
+    checkpoint.last_id = rows[-1]['id']
+    checkpoint.completed += len(updates)
+    checkpoint.save()
+    return len(updates)
+
+async def reembed(conn, args, checkpoint):
+    condition, query_args = build_image_filter(args.status, args.since, args.until, args.location)
+    loop = asyncio.get_running_loop()
+    throttle = Throttle(args.max_rows_per_sec)
+    in_flight = deque()
+    start = time.monotonic()
+    written = 0
+
+    executor = ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(args.backend, args.model, args.threads)
+    )
+
+    async def drain_one():
+        nonlocal written
+        rows, future = in_flight.popleft()
+        vectors = await future
+        written += await write_batch(conn, args.table, args.shadow_column, rows, vectors, checkpoint)
+        await throttle.wait(len(rows))
+        logging.info(f"Re-embedded {checkpoint.completed} rows ({written / (time.monotonic() - start):.1f} rows/s), last id {checkpoint.last_id}")
+
+    # Reading uses its own connection so it can run ahead while results are written
+    reader_conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        async for rows in fetch_batches(reader_conn, args.table, condition, query_args, checkpoint.last_id, args.batch_size):
+            future = loop.run_in_executor(executor, _embed_batch, [row['s3_url'] for row in rows])
+            in_flight.append((rows, future))
+            # Keep every worker busy, but write results back in id order so the checkpoint stays valid
+            if len(in_flight) >= args.workers * 2:
+                await drain_one()
+        while in_flight:
+            await drain_one()
+    finally:
+        await reader_conn.close()
+        executor.shutdown(cancel_futures=True)
+
+    logging.info(f"Re-embedding finished: {checkpoint.completed} rows written, {len(checkpoint.failed)} failed")
+
+async def column_type(conn, table, column):
+    return await conn.fetchval("""
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = $1::regclass AND attname = $2 AND NOT attisdropped
+    """, table, column)
+
+async def list_partitions(conn, table):
+    rows = await conn.fetch("""
+        SELECT c.relname AS name
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = $1::regclass
+        ORDER BY c.relname
+    """, table)
+    return [row['name'] for row in rows]
+
+async def create_index_concurrently(conn, index, table, column):
+    valid = await conn.fetchval("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", index)
+    if valid is False:
+        # Left behind by an interrupted concurrent build
+        await conn.execute(f"DROP INDEX CONCURRENTLY {index}")
+    if not valid:
+        await conn.execute(f"CREATE INDEX CONCURRENTLY {index} ON {table} USING ivfflat ({column} vector_l2_ops)")
+
+async def build_shadow_index(conn, table, shadow):
+    """
+    Build the ivfflat index of the shadow column without blocking writes.
+
+    CREATE INDEX CONCURRENTLY does not work on partitioned tables, so each
+    partition is indexed concurrently and attached to an index created ON ONLY
+    the parent, which becomes valid once every partition is attached.
+    """
+    index = f"idx_{table}_{shadow}"
+    partitions = await list_partitions(conn, table)
+    if not partitions:
+        logging.info(f"Building vector index on {table}.{shadow}")
+        await create_index_concurrently(conn, index, table, shadow)
+        return
+
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS {index} ON ONLY {table} USING ivfflat ({shadow} vector_l2_ops)")
+    for partition in partitions:
+        logging.info(f"Building vector index on {partition}.{shadow}")
+        await create_index_concurrently(conn, f"{partition}_{shadow}_idx", partition, shadow)
+        # Does nothing when the index is already attached, so an interrupted cutover can be re-run
+        await conn.execute(f"ALTER INDEX {index} ATTACH PARTITION {partition}_{shadow}_idx")
+
+async def cutover(conn, args, full_corpus):
+    table = args.table
+    shadow = args.shadow_column
+    shadow_type = await column_type(conn, table, shadow)
+    if shadow_type is None:
+        raise ValueError(f"Shadow column {shadow} does not exist; nothing to cut over")
+
+    if full_corpus:
+        # Build the index before taking the lock, so the swap itself is quick
+        await build_shadow_index(conn, table, shadow)
+        dim = int(shadow_type[len('vector('):-1])
+        zero_vector = json.dumps([0.0] * dim)
+        async with conn.transaction():
+            await conn.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+            views = {}
+            for view in DEPENDENT_VIEWS:
+                definition = await conn.fetchval("SELECT pg_get_viewdef(to_regclass($1))", view)
+                if definition:
+                    views[view] = definition
+                    await conn.execute(f"DROP VIEW {view}")
+            await conn.execute(f"ALTER TABLE {table} DROP COLUMN vector")
+            await conn.execute(f"ALTER TABLE {table} RENAME COLUMN {shadow} TO vector")
+            await conn.execute(f"ALTER INDEX idx_{table}_{shadow} RENAME TO {VECTOR_INDEXES[table]}")
+            # Free the shadow names for the next migration; the old partition indexes went with the old column.
+            # Partitions created during the build got their index from the parent under the same name.
+            for partition in await list_partitions(conn, table):
+                await conn.execute(f"ALTER INDEX IF EXISTS {partition}_{shadow}_idx RENAME TO {partition}_vector_idx")
+            # Rows that could not be embedded go back to pending with a zero vector, like new uploads
+            missing = await conn.execute(f"UPDATE {table} SET vector = $1, status = 'pending' WHERE vector IS NULL", zero_vector)
+            await conn.execute(f"UPDATE {table} SET status = 'completed' WHERE status = 'pending' AND vector <> $1", zero_vector)
+            await conn.execute(f"ALTER TABLE {table} ALTER COLUMN vector SET NOT NULL")
+            for view, definition in views.items():
+                await conn.execute(f"CREATE VIEW {view} AS {definition}")
+        logging.info(f"Swapped {shadow} into vector ({shadow_type})")
+        if missing.split()[-1] != '0':
+            logging.warning(f"{missing.split()[-1]} rows had no new vector and are pending again; re-run with --status pending once the server uses the new model")
+    else:
+        live_type = await column_type(conn, table, 'vector')
+        if live_type != shadow_type:
+            raise ValueError(f"Cannot copy {shadow_type} into {live_type}; a model change needs a full-corpus job")
+        # Only the rows selected by the job; the shadow column may hold vectors from other rows
+        condition, query_args = build_image_filter(args.status, args.since, args.until, args.location)
+        async with conn.transaction():
+            result = await conn.execute(f"""
+                UPDATE {table} SET vector = {shadow}, status = 'completed'
+                WHERE {shadow} IS NOT NULL AND {condition}
+            """, *query_args)
+            await conn.execute(f"ALTER TABLE {table} DROP COLUMN {shadow}")
+        logging.info(f"Copied {result.split()[-1]} vectors from {shadow} into vector")
+
+async def run(args):
+    job = {
+        'status': args.status, 'since': args.since and args.since.isoformat(),
+        'until': args.until and args.until.isoformat(), 'location': args.location,
+        'backend': args.backend, 'model': args.model, 'table': args.table, 'shadow_column': args.shadow_column,
+    }
+    checkpoint = Checkpoint(args.checkpoint, job)
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        # A new job must not mix its vectors with those left behind by an earlier, abandoned one
+        if not checkpoint.resumed and await column_type(conn, args.table, args.shadow_column) is not None:
+            raise ValueError(
+                f"{args.table}.{args.shadow_column} already exists but there is no checkpoint at {args.checkpoint}; "
+                f"drop the column or pass --shadow-column to start a new job"
+            )
+        await reembed(conn, args, checkpoint)
+        if args.cutover:
+            full_corpus = not (args.status or args.since or args.until or args.location)
+            await cutover(conn, args, full_corpus)
+            checkpoint.remove()
+    finally:
+        await conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-embed images in bulk into a shadow column and cut over atomically.")
+    parser.add_argument("--status", nargs='+', help="Only rows with these statuses (e.g. pending)")
+    parser.add_argument("--since", type=parse_timestamp, help="Only rows captured at or after this ISO timestamp")
+    parser.add_argument("--until", type=parse_timestamp, help="Only rows captured before this ISO timestamp")
+    parser.add_argument("--location", nargs='+', help="Only rows from these locations")
+    parser.add_argument("--backend", default=os.getenv('EMBEDDING_BACKEND', 'reference'), help="Embedding backend name")
+    parser.add_argument("--model", default=os.getenv('CLIP_MODEL', 'ViT-B/32'), help="CLIP model to embed with")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 2), help="Embedding processes")
+    parser.add_argument("--threads", type=int, default=0, help="Intra-op threads per process (default: cores / workers)")
+    parser.add_argument("--batch-size", type=int, default=32, help="Images per batch")
+    parser.add_argument("--max-rows-per-sec", type=float, default=0, help="Write throttle (0 disables it)")
+    parser.add_argument("--table", default='image_data', choices=list(VECTOR_INDEXES), help="Table to re-embed (image_data_archive holds rows moved by retention.py)")
+    parser.add_argument("--shadow-column", default='vector_next', help="Column the new vectors are written to")
+    parser.add_argument("--checkpoint", default='reembed_checkpoint.json', help="Checkpoint file used to resume")
+    parser.add_argument("--cutover", action="store_true", help="Replace the live vectors once all rows are done")
+    args = parser.parse_args()
+
+    if not args.shadow_column.isidentifier():
+        parser.error("--shadow-column must be a plain column name")
+    if args.threads <= 0:
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        logging.info("Interrupted; run the same command again to resume from the checkpoint")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+"""
+Storage tiering and retention for old captures.
+
+Applies the policies from a JSON file (see retention_policy.example.json). Each
+policy matches locations by glob pattern; the first matching policy wins. A
+policy may set any of:
+
+- dedupe_after_days: collapse runs of near-duplicate captures older than this
+  to their first image (`dedupe_distance` is the maximum L2 distance between
+  normalised CLIP vectors, `dedupe_max_gap_seconds` the maximum time between
+  consecutive captures of a run);
+- recompress_after_days: replace originals older than this with a small
+  archival copy (`archive_format`);
+- archive_after_days: move rows older than this from image_data to
+  image_data_archive, whose partitions mirror those of image_data. Vectors and
+  metadata stay queryable there and through the image_data_all view;
+- delete_after_days: delete rows and files older than this from both tables.
+
+Live partitions that only contain rows past every location's archive age are
+moved to the archive as a whole, without rewriting rows.
+
+Nothing is moved to the archive while the two tables' columns differ, e.g.
+while a reembed.py job has a shadow column on one of them, or after only one of
+them was migrated to another model; the run logs a warning and goes on.
+
+Requires sql/add_retention.sql to have been applied.
+
+Usage:
+    python retention.py retention_policy.json --dry-run
+"""
+import os
+import re
+import json
+import asyncio
+import logging
+import argparse
+from fnmatch import fnmatch
+from datetime import datetime, timedelta, timezone
+
+import asyncpg
+import numpy as np
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL', 'dbname=pgdatabase user=pguser password=pgpassword host=localhost')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+TABLES = ('image_data', 'image_data_archive')
+COLUMNS = 'id, image_id, s3_url, status, timestamp, location, vector, created_at, updated_at, archived_at'
+PARTITION_BOUND = re.compile(r"FOR VALUES FROM \('(.+)'\) TO \('(.+)'\)")
+
+DEFAULT_ARCHIVE_FORMAT = {'format': 'webp', 'quality': 60, 'max_side': 1024}
+
+def parse_vector(value: str) -> np.ndarray:
+    return np.fromstring(value[1:-1], sep=',', dtype=np.float32)
+
+def parse_bound(value: str) -> datetime:
+    # Postgres prints offsets as '+00', which fromisoformat only accepts from Python 3.11
+    if re.search(r'[+-]\d\d$', value):
+        value += ':00'
+    return datetime.fromisoformat(value).astimezone(timezone.utc)
+
+def column_mismatches(live: dict, archive: dict) -> dict:
+    """
+    Return {column: (live type, archive type)} for the columns that differ between the tables.
+
+    A re-embedding job adds a shadow column to one table, and a model migration
+    changes the vector dimension of one table, until the other one follows.
+    """
+    columns = sorted(set(live) | set(archive))
+    return {column: (live.get(column), archive.get(column)) for column in columns if live.get(column) != archive.get(column)}
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.error(f"Could not remove {path}: {e}")
+
+def recompress_image(path, image_id, archive_dir, archive_format):
+    """Write a downscaled archival copy of `path` into `archive_dir` and return its path."""
+    os.makedirs(archive_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    # Upload filenames repeat across capture sessions, so the image id keeps archive names unique
+    archive_path = os.path.join(archive_dir, f"{stem}_{image_id}.{archive_format['format']}")
+    with Image.open(path) as img:
+        img = img.convert('RGB')
+        img.thumbnail((archive_format['max_side'], archive_format['max_side']))
+        img.save(archive_path, quality=archive_format['quality'])
+    return archive_path
+
+class DuplicateRuns:
+    """
+    Finds runs of near-duplicate captures in rows ordered by location and timestamp.
+
+    A run starts with a representative capture; later captures of the same
+    location belong to the run while each follows the previous one within
+    `max_gap` and stays within `max_distance` of the representative.
+    """
+
+    def __init__(self, max_distance: float, max_gap: timedelta):
+        self.max_distance = max_distance
+        self.max_gap = max_gap
+        self.representative = None
+        self.previous = None
+
+    def is_duplicate(self, location, timestamp, vector: np.ndarray) -> bool:
+        duplicate = (self.representative is not None and location == self.previous[0]
+                     and timestamp - self.previous[1] <= self.max_gap
+                     and vector.shape == self.representative.shape  # the tables may hold vectors of different models
+                     and np.linalg.norm(vector - self.representative) <= self.max_distance)
+        if not duplicate:
+            self.representative = vector
+        self.previous = (location, timestamp)
+        return duplicate
+
+class RetentionEngine:
+    def __init__(self, db_pool, config: dict, dry_run: bool = False, batch_size: int = 500):
+        self.db_pool = db_pool
+        self.policies = config['policies']
+        self.archive_dir = config.get('archive_dir', os.path.join('photos', 'archive'))
+        self.archive_format = {**DEFAULT_ARCHIVE_FORMAT, **config.get('archive_format', {})}
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.now = datetime.now(timezone.utc)
+
+    def policy_for(self, location: str):
+        return next((policy for policy in self.policies if fnmatch(location, policy['location'])), None)
+
+    def cutoff(self, policy, key):
+        days = policy.get(key)
+        return None if days is None else self.now - timedelta(days=days)
+
+    async def locations_by_policy(self):
+        """Group all known locations by the index of the policy that applies to them."""
+        async with self.db_pool.acquire() as conn:
+            rows = await conn.fetch(f"SELECT DISTINCT location FROM {TABLES[0]} UNION SELECT DISTINCT location FROM {TABLES[1]}")
+        groups = {}
+        for row in rows:
+            policy = self.policy_for(row['location'])
+            if policy is None:
+                continue
+            groups.setdefault(self.policies.index(policy), []).append(row['location'])
+        return [(self.policies[index], locations) for index, locations in groups.items()]
+
+    async def dedupe(self, policy, locations):
+        """Delete captures that are near-duplicates of the first image of their run."""
+        cutoff = self.cutoff(policy, 'dedupe_after_days')
+        if cutoff is None:
+            return
+        max_distance = policy.get('dedupe_distance', 0.1)
+        max_gap = timedelta(seconds=policy.get('dedupe_max_gap_seconds', 600))
+
+        duplicates = {table: [] for table in TABLES}
+        runs = DuplicateRuns(max_distance, max_gap)
+        async with self.db_pool.acquire() as conn:
+            async with conn.transaction():
+                # Both tables, so runs are found even when part of them has been archived already.
+                # Already recompressed rows were deduplicated when they were still originals.
+                cursor = conn.cursor(f"""
+                    SELECT id, timestamp, location, s3_url, vector, '{TABLES[0]}' AS source FROM {TABLES[0]}
+                    WHERE location = ANY($1) AND timestamp < $2 AND status = 'completed' AND archived_at IS NULL
+                    UNION ALL
+                    SELECT id, timestamp, location, s3_url, vector, '{TABLES[1]}' AS source FROM {TABLES[1]}
+                    WHERE location = ANY($1) AND timestamp < $2 AND status = 'completed' AND archived_at IS NULL
+                    ORDER BY location, timestamp
+                """, locations, cutoff, prefetch=self.batch_size)
+                async for row in cursor:
+                    if runs.is_duplicate(row['location'], row['timestamp'], parse_vector(row['vector'])):
+                        duplicates[row['source']].append((row['id'], row['timestamp'], row['s3_url']))
+
+        for table, rows in duplicates.items():
+            logging.info(f"Dedupe {locations} in {table}: {len(rows)} near-duplicate captures")
+            await self._delete_rows(table, rows)
+
+    async def recompress(self, policy, locations):
+        """Replace originals past the policy age with archival copies."""
+        cutoff = self.cutoff(policy, 'recompress_after_days')
+        if cutoff is None:
+            return
+        for table in TABLES:
+            count = 0
+            last_id = 0
+            while True:
+                async with self.db_pool.acquire() as conn:
+                    rows = await conn.fetch(f"""
+                        SELECT id, image_id, timestamp, s3_url FROM {table}
+                        WHERE location = ANY($1) AND timestamp < $2 AND archived_at IS NULL AND id > $3
+                        ORDER BY id LIMIT $4
+                    """, locations, cutoff, last_id, self.batch_size)
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+                count += len(rows)
+                if not self.dry_run:
+                    await self._recompress_rows(table, rows)
+            logging.info(f"Recompress {locations} in {table}: {count} originals")
+
+    async def _recompress_rows(self, table, rows):
+        updates = []
+        originals = []
+        for row in rows:
+            try:
+                archive_path = await asyncio.to_thread(
+                    recompress_image, row['s3_url'], row['image_id'], self.archive_dir, self.archive_format
+                )
+            except Exception as e:
+                logging.error(f"Failed to recompress {row['s3_url']}: {e}")
+                continue
+            updates.append((archive_path, self.now, row['id'], row['timestamp']))
+            if os.path.abspath(archive_path) != os.path.abspath(row['s3_url']):
+                originals.append(row['s3_url'])
+        async with self.db_pool.acquire() as conn:
+            await conn.executemany(f"""
+                UPDATE {table} SET s3_url = $1, archived_at = $2
+                WHERE id = $3 AND timestamp = $4
+            """, updates)
+            # Originals are removed only once the rows point at their archival copies
+            await self._remove_unreferenced_files(conn, originals)
+
+    async def _remove_unreferenced_files(self, conn, paths):
+        """
+        Remove the files at `paths` that no row references any more.
+
+        Upload filenames repeat across capture sessions, so a newer row may point
+        at the same file as the row that was just deleted or recompressed.
+        """
+        paths = list(set(paths))
+        if not paths:
+            return
+        referenced = {
+            row['s3_url'] for row in await conn.fetch(f"""
+                SELECT s3_url FROM {TABLES[0]} WHERE s3_url = ANY($1)
+                UNION
+                SELECT s3_url FROM {TABLES[1]} WHERE s3_url = ANY($1)
+            """, paths)
+        }
+        for path in paths:
+            if path in referenced:
+                logging.info(f"Keeping {path}: still referenced by another row")
+            else:
+                remove_file(path)
+
+    async def partitions(self, conn, table):
+        """Return [(name, lower, upper)] for the range partitions of `table`."""
+        rows = await conn.fetch("""
+            SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = $1::regclass
+        """, table)
+        partitions = []
+        for row in rows:
+            match = PARTITION_BOUND.match(row['bound'])
+            if match:
+                lower, upper = (parse_bound(value) for value in match.groups())
+                partitions.append((row['name'], lower, upper))
+        return partitions
+
+    async def column_types(self, conn, table):
+        rows = await conn.fetch("""
+            SELECT attname, format_type(atttypid, atttypmod) AS type FROM pg_attribute
+            WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped
+        """, table)
+        return {row['attname']: row['type'] for row in rows}
+
+    async def archive_mismatches(self, conn):
+        return column_mismatches(await self.column_types(conn, TABLES[0]), await self.column_types(conn, TABLES[1]))
+
+    async def archive_partitions(self):
+        """Move whole live partitions to the archive when every location allows it."""
+        cutoffs = [self.cutoff(policy, 'archive_after_days') for policy in self.policies]
+        if not cutoffs or None in cutoffs or not any(policy['location'] == '*' for policy in self.policies):
+            return
+        cutoff = min(cutoffs)
+        async with self.db_pool.acquire() as conn:
+            # ATTACH PARTITION needs the partition to have exactly the archive's columns
+            mismatches = await self.archive_mismatches(conn)
+            if mismatches:
+                logging.warning(f"Skipping partition archiving: {TABLES[0]} and {TABLES[1]} columns differ {mismatches}; "
+                                f"finish or cut over running reembed.py jobs and migrate both tables to the same model")
+                return
+            archived = {name for name, _, _ in await self.partitions(conn, TABLES[1])}
+            for name, lower, upper in await self.partitions(conn, TABLES[0]):
+                if upper > cutoff or f"{name}_archive" in archived:
+                    continue
+                logging.info(f"Archive partition {name} ({lower:%Y-%m-%d} to {upper:%Y-%m-%d})")
+                if self.dry_run:
+                    continue
+                async with conn.transaction():
+                    await conn.execute(f"ALTER TABLE {TABLES[0]} DETACH PARTITION {name}")
+                    await conn.execute(f"ALTER TABLE {name} RENAME TO {name}_archive")
+                    await conn.execute(f"""
+                        ALTER TABLE {TABLES[1]} ATTACH PARTITION {name}_archive
+                        FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')
+                    """)
+
+    async def archive_rows(self, policy, locations):
+        """Move rows past the policy age into the matching archive partitions."""
+        cutoff = self.cutoff(policy, 'archive_after_days')
+        if cutoff is None:
+            return
+        async with self.db_pool.acquire() as conn:
+            # Moved rows would lose the vectors a running reembed.py job wrote to its shadow column
+            mismatches = await self.archive_mismatches(conn)
+            if mismatches:
+                logging.warning(f"Skipping archiving of {locations}: {TABLES[0]} and {TABLES[1]} columns differ {mismatches}; "
+                                f"finish or cut over running reembed.py jobs and migrate both tables to the same model")
+                return
+            archived = {name for name, _, _ in await self.partitions(conn, TABLES[1])}
+            for name, lower, upper in await self.partitions(conn, TABLES[0]):
+                if lower >= cutoff:
+                    continue
+                if f"{name}_archive" not in archived and not self.dry_run:
+                    await conn.execute(f"""
+                        CREATE TABLE {name}_archive PARTITION OF {TABLES[1]}
+                        FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')
+                    """)
+
+            if self.dry_run:
+                moved = await conn.fetchval(f"""
+                    SELECT count(*) FROM {TABLES[0]} WHERE location = ANY($1) AND timestamp < $2
+                """, locations, cutoff)
+                logging.info(f"Archive {locations}: {moved} rows to move")
+                return
+
+            moved = 0
+            while True:
+                result = await conn.execute(f"""
+                    WITH moved AS (
+                        DELETE FROM {TABLES[0]} WHERE (id, timestamp) IN (
+                            SELECT id, timestamp FROM {TABLES[0]}
+                            WHERE location = ANY($1) AND timestamp < $2
+                            LIMIT $3
+                        )
+                        RETURNING {COLUMNS}
+                    )
+                    INSERT INTO {TABLES[1]} ({COLUMNS}) SELECT {COLUMNS} FROM moved
+                """, locations, cutoff, self.batch_size)
+                count = int(result.split()[-1])
+                moved += count
+                if count < self.batch_size:
+                    break
+        logging.info(f"Archive {locations}: {moved} rows moved")
+
+    async def delete_expired(self, policy, locations):
+        """Delete rows and files past the policy's delete age."""
+        cutoff = self.cutoff(policy, 'delete_after_days')
+        if cutoff is None:
+            return
+        for table in TABLES:
+            async with self.db_pool.acquire() as conn:
+                rows = await conn.fetch(f"""
+                    SELECT id, timestamp, s3_url FROM {table}
+                    WHERE location = ANY($1) AND timestamp < $2
+                """, locations, cutoff)
+            logging.info(f"Delete {locations} in {table}: {len(rows)} expired rows")
+            await self._delete_rows(table, [(row['id'], row['timestamp'], row['s3_url']) for row in rows])
+
+    async def _delete_rows(self, table, rows):
+        if self.dry_run:
+            return
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            async with self.db_pool.acquire() as conn:
+                await conn.executemany(f"DELETE FROM {table} WHERE id = $1 AND timestamp = $2", [row[:2] for row in batch])
+                await self._remove_unreferenced_files(conn, [path for _, _, path in batch])
+
+    async def drop_empty_partitions(self):
+        """Drop live partitions that archiving has emptied and that no longer receive rows."""
+        async with self.db_pool.acquire() as conn:
+            for name, _, upper in await self.partitions(conn, TABLES[0]):
+                if upper > self.now or await conn.fetchval(f"SELECT EXISTS (SELECT 1 FROM {name})"):
+                    continue
+                logging.info(f"Drop empty partition {name}")
+                if not self.dry_run:
+                    async with conn.transaction():
+                        await conn.execute(f"ALTER TABLE {TABLES[0]} DETACH PARTITION {name}")
+                        await conn.execute(f"DROP TABLE {name}")
+
+    async def run(self):
+        if self.dry_run:
+            logging.info("Dry run: no rows or files will be changed")
+        groups = await self.locations_by_policy()
+        # Deleting and deduplicating first keeps whole-partition moves from carrying expired or duplicate rows along
+        for policy, locations in groups:
+            await self.delete_expired(policy, locations)
+            await self.dedupe(policy, locations)
+        await self.archive_partitions()
+        for policy, locations in groups:
+            await self.recompress(policy, locations)
+            await self.archive_rows(policy, locations)
+        await self.drop_empty_partitions()
+
+async def run(args):
+    with open(args.policy) as f:
+        config = json.load(f)
+    db_pool = await asyncpg.create_pool(DATABASE_URL)
+    try:
+        await RetentionEngine(db_pool, config, dry_run=args.dry_run, batch_size=args.batch_size).run()
+    finally:
+        await db_pool.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply storage tiering and retention policies to old captures.")
+    parser.add_argument("policy", help="JSON file with the retention policies")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be done without changing anything")
+    parser.add_argument("--batch-size", type=int, default=500, help="Rows per batch")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
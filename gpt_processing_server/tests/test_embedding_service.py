@@ -0,0 +1,46 @@
+import asyncio
+
+import numpy as np
+
+from embedding_service import Batcher
+
+class FakeBackend:
+    """Embeds each item as [item]; fails any call containing a 'bad' item."""
+
+    def __init__(self):
+        self.calls = []
+
+    def embed(self, items):
+        self.calls.append(list(items))
+        if 'bad' in items:
+            raise ValueError('unreadable image')
+        return np.array([[float(len(item))] for item in items])
+
+async def submit_all(batcher, requests):
+    runner = asyncio.create_task(batcher.run())
+    try:
+        return await asyncio.gather(*(batcher.submit(items) for items in requests), return_exceptions=True)
+    finally:
+        runner.cancel()
+
+def test_requests_are_coalesced_and_split_back():
+    backend = FakeBackend()
+    batcher = Batcher(backend.embed, max_batch=8, max_wait=0.05)
+    results = asyncio.run(submit_all(batcher, [['a'], ['bb', 'ccc'], ['dddd']]))
+    assert backend.calls == [['a', 'bb', 'ccc', 'dddd']]
+    assert [result.ravel().tolist() for result in results] == [[1.0], [2.0, 3.0], [4.0]]
+
+def test_batches_are_flushed_at_max_batch():
+    backend = FakeBackend()
+    batcher = Batcher(backend.embed, max_batch=2, max_wait=0.05)
+    asyncio.run(submit_all(batcher, [['a'], ['b'], ['c']]))
+    assert backend.calls == [['a', 'b'], ['c']]
+
+def test_failed_batch_is_retried_per_request():
+    backend = FakeBackend()
+    batcher = Batcher(backend.embed, max_batch=8, max_wait=0.05)
+    good, bad, other = asyncio.run(submit_all(batcher, [['a'], ['bad'], ['cc']]))
+    assert backend.calls == [['a', 'bad', 'cc'], ['a'], ['bad'], ['cc']]
+    assert good.ravel().tolist() == [1.0]
+    assert other.ravel().tolist() == [2.0]
+    assert isinstance(bad, ValueError)
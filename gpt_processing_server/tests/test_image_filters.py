@@ -0,0 +1,22 @@
+from datetime import datetime, timezone
+
+from image_filters import build_image_filter, parse_timestamp
+
+def test_no_filters_selects_everything():
+    assert build_image_filter() == ("TRUE", [])
+
+def test_filters_are_numbered_in_order():
+    since = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    condition, args = build_image_filter(['pending'], since, None, ['kitchen'])
+    assert condition == "status = ANY($1) AND timestamp >= $2 AND location = ANY($3)"
+    assert args == [['pending'], since, ['kitchen']]
+
+def test_first_param_offsets_placeholders():
+    until = datetime(2024, 7, 1, tzinfo=timezone.utc)
+    condition, args = build_image_filter(until=until, locations=('garage',), first_param=3)
+    assert condition == "timestamp < $3 AND location = ANY($4)"
+    assert args == [until, ['garage']]
+
+def test_parse_timestamp_treats_naive_values_as_utc():
+    assert parse_timestamp('2024-06-01') == datetime(2024, 6, 1, tzinfo=timezone.utc)
+    assert parse_timestamp('2024-06-01T12:00:00+02:00') == datetime(2024, 6, 1, 10, tzinfo=timezone.utc)
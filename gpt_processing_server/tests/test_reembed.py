@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+from reembed import Checkpoint
+
+JOB = {'status': ['pending'], 'since': None, 'until': None, 'location': None,
+       'backend': 'reference', 'model': 'ViT-B/32', 'table': 'image_data', 'shadow_column': 'vector_next'}
+
+def test_new_checkpoint_starts_from_scratch(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'), JOB)
+    assert not checkpoint.resumed
+    assert (checkpoint.last_id, checkpoint.completed, checkpoint.failed) == (0, 0, [])
+
+def test_checkpoint_resumes_saved_progress(tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    checkpoint = Checkpoint(path, JOB)
+    checkpoint.last_id = 42
+    checkpoint.completed = 40
+    checkpoint.failed = [7, 13]
+    checkpoint.save()
+
+    resumed = Checkpoint(path, dict(JOB))
+    assert resumed.resumed
+    assert (resumed.last_id, resumed.completed, resumed.failed) == (42, 40, [7, 13])
+    assert not (tmp_path / 'checkpoint.json.tmp').exists()
+
+def test_checkpoint_of_another_job_is_rejected(tmp_path):
+    path = tmp_path / 'checkpoint.json'
+    path.write_text(json.dumps({'job': {**JOB, 'model': 'RN50'}, 'last_id': 1, 'completed': 1, 'failed': []}))
+    with pytest.raises(ValueError, match='different job'):
+        Checkpoint(str(path), JOB)
+
+def test_remove_deletes_the_file(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'), JOB)
+    checkpoint.save()
+    checkpoint.remove()
+    checkpoint.remove()
+    assert not (tmp_path / 'checkpoint.json').exists()
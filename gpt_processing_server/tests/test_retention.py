@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from retention import DuplicateRuns, column_mismatches, parse_bound, parse_vector
+
+START = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+def find_duplicates(rows, max_distance=0.1, max_gap=timedelta(minutes=10)):
+    runs = DuplicateRuns(max_distance, max_gap)
+    return [name for name, location, minutes, vector in rows
+            if runs.is_duplicate(location, START + timedelta(minutes=minutes), np.array(vector, dtype=np.float32))]
+
+def test_near_duplicates_collapse_to_the_first_capture():
+    rows = [
+        ('a', 'kitchen', 0, [1.0, 0.0]),
+        ('b', 'kitchen', 5, [1.0, 0.05]),
+        ('c', 'kitchen', 10, [1.0, 0.08]),
+    ]
+    assert find_duplicates(rows) == ['b', 'c']
+
+def test_distance_is_measured_against_the_representative():
+    # Each capture is close to the previous one, but the scene drifts away from the first
+    rows = [
+        ('a', 'kitchen', 0, [1.0, 0.0]),
+        ('b', 'kitchen', 1, [1.0, 0.08]),
+        ('c', 'kitchen', 2, [1.0, 0.16]),
+        ('d', 'kitchen', 3, [1.0, 0.2]),
+    ]
+    assert find_duplicates(rows) == ['b', 'd']
+
+def test_gap_between_captures_ends_a_run():
+    rows = [
+        ('a', 'kitchen', 0, [1.0, 0.0]),
+        ('b', 'kitchen', 8, [1.0, 0.0]),
+        ('c', 'kitchen', 16, [1.0, 0.0]),
+        ('d', 'kitchen', 40, [1.0, 0.0]),
+    ]
+    assert find_duplicates(rows) == ['b', 'c']
+
+def test_runs_do_not_cross_locations():
+    rows = [
+        ('a', 'garage', 0, [1.0, 0.0]),
+        ('b', 'kitchen', 1, [1.0, 0.0]),
+        ('c', 'kitchen', 2, [1.0, 0.0]),
+    ]
+    assert find_duplicates(rows) == ['c']
+
+def test_vectors_of_different_models_are_never_duplicates():
+    rows = [
+        ('a', 'kitchen', 0, [1.0, 0.0]),
+        ('b', 'kitchen', 1, [1.0, 0.0, 0.0]),
+        ('c', 'kitchen', 2, [1.0, 0.0, 0.0]),
+    ]
+    assert find_duplicates(rows) == ['c']
+
+def test_column_mismatches():
+    live = {'id': 'integer', 'vector': 'vector(768)', 'vector_next': 'vector(768)'}
+    archive = {'id': 'integer', 'vector': 'vector(512)'}
+    assert column_mismatches(live, live) == {}
+    assert column_mismatches(live, archive) == {
+        'vector': ('vector(768)', 'vector(512)'),
+        'vector_next': ('vector(768)', None),
+    }
+
+def test_parse_vector_and_bound():
+    assert parse_vector('[0.5,-1,2]').tolist() == [0.5, -1.0, 2.0]
+    assert parse_bound('2024-06-01 00:00:00+02') == datetime(2024, 5, 31, 22, tzinfo=timezone.utc)
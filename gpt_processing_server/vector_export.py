@@ -0,0 +1,240 @@
+"""
+Bulk export of image embeddings as an Arrow IPC stream.
+
+Rows are read with a server-side cursor inside a read-only snapshot and
+written out one record batch at a time, so memory stays flat however many rows
+are exported. Vectors are decoded from pgvector's binary format straight into
+float32 blocks. Each batch has the columns image_id, timestamp (UTC), location
+and vector (fixed-size list of float32).
+
+Reading an export:
+    import pyarrow as pa
+    table = pa.ipc.open_stream(open('vectors.arrow', 'rb')).read_all()
+    vectors = table.column('vector').combine_chunks().flatten().to_numpy().reshape(len(table), -1)
+
+Usage:
+    python vector_export.py vectors.arrow --since 2024-06-01 --location kitchen
+    python vector_export.py /dev/null --batch-size 50000   # benchmark rows/s
+"""
+import os
+import sys
+import time
+import struct
+import asyncio
+import logging
+import argparse
+
+import asyncpg
+import numpy as np
+import pyarrow as pa
+from dotenv import load_dotenv
+
+from image_filters import build_image_filter, parse_timestamp
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL', 'dbname=pgdatabase user=pguser password=pgpassword host=localhost')
+# Tables behind each source; image_data_all and image_data_archive exist once sql/add_retention.sql has been applied
+EXPORT_SOURCES = {
+    'image_data': ('image_data',),
+    'image_data_archive': ('image_data_archive',),
+    'image_data_all': ('image_data', 'image_data_archive'),
+}
+ARROW_STREAM_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def _encode_vector(vector):
+    return struct.pack(f'>HH{len(vector)}f', len(vector), 0, *vector)
+
+def _decode_vector(data):
+    # Keep the big-endian float4 payload as bytes; batches are converted in one numpy call
+    dim, = struct.unpack_from('>H', data)
+    return dim, data[4:]
+
+async def register_vector_codec(conn):
+    """Exchange pgvector values in binary. Only use on connections dedicated to exporting."""
+    await conn.set_type_codec('vector', schema='public', encoder=_encode_vector, decoder=_decode_vector, format='binary')
+
+def export_schema(dim: int = None) -> pa.Schema:
+    vector_type = pa.list_(pa.float32(), dim) if dim else pa.list_(pa.float32())
+    return pa.schema([
+        ('image_id', pa.string()),
+        ('timestamp', pa.timestamp('us', tz='UTC')),
+        ('location', pa.string()),
+        ('vector', vector_type),
+    ])
+
+async def check_source(conn, source) -> int:
+    """
+    Check that `source` can be exported and return its vector dimension.
+
+    Raises ValueError when the source is unknown, does not exist yet, or mixes
+    vectors of different dimensions (e.g. after migrating only image_data).
+    """
+    if source not in EXPORT_SOURCES:
+        raise ValueError(f"Unknown export source '{source}'. Expected one of: {', '.join(EXPORT_SOURCES)}")
+    if not await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", source):
+        raise ValueError(f"{source} does not exist; apply sql/add_retention.sql first")
+    dims = {}
+    for table in EXPORT_SOURCES[source]:
+        # pgvector stores the dimension as the column's type modifier
+        dims[table] = await conn.fetchval("""
+            SELECT atttypmod FROM pg_attribute
+            WHERE attrelid = $1::regclass AND attname = 'vector' AND NOT attisdropped
+        """, table)
+    if len(set(dims.values())) > 1:
+        raise ValueError(f"{source} mixes vector dimensions ({dims}); export the tables separately")
+    return next(iter(dims.values()))
+
+def to_record_batch(rows) -> pa.RecordBatch:
+    dims = {row['vector'][0] for row in rows}
+    if len(dims) > 1:
+        raise ValueError(f"Rows have mixed vector dimensions {sorted(dims)}")
+    dim = dims.pop()
+    payload = b''.join(row['vector'][1] for row in rows)
+    vectors = np.frombuffer(payload, dtype='>f4').astype(np.float32).reshape(len(rows), dim)
+    return pa.RecordBatch.from_arrays([
+        pa.array([row['image_id'] for row in rows], type=pa.string()),
+        pa.array([row['timestamp_us'] for row in rows], type=pa.timestamp('us', tz='UTC')),
+        pa.array([row['location'] for row in rows], type=pa.string()),
+        pa.FixedSizeListArray.from_arrays(pa.array(vectors.ravel(), type=pa.float32()), dim),
+    ], schema=export_schema(dim))
+
+async def iter_record_batches(conn, source='image_data', statuses=None, since=None, until=None, locations=None, batch_size=10000):
+    """Yield record batches of the selected rows, ordered by timestamp. Call check_source first."""
+    if source not in EXPORT_SOURCES:
+        raise ValueError(f"Unknown export source '{source}'. Expected one of: {', '.join(EXPORT_SOURCES)}")
+    condition, args = build_image_filter(statuses, since, until, locations)
+    query = f"""
+        SELECT image_id::text AS image_id,
+               (extract(epoch FROM timestamp) * 1000000)::bigint AS timestamp_us,
+               location, vector
+        FROM {source}
+        WHERE {condition}
+        ORDER BY timestamp
+    """
+    async with conn.transaction(isolation='repeatable_read', readonly=True):
+        cursor = await conn.cursor(query, *args)
+        while True:
+            rows = await cursor.fetch(batch_size)
+            if not rows:
+                return
+            yield to_record_batch(rows)
+
+class _ChunkSink:
+    """File-like object that collects what the Arrow writer produces until it is drained."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def write_batch(writer, schema, batch):
+    if not batch.schema.equals(schema):
+        raise ValueError(f"Vector dimension changed during the export: {batch.schema.field('vector').type}")
+    writer.write_batch(batch)
+
+def stream_schema(dim, first_batch):
+    if dim > 0:
+        return export_schema(dim)
+    # The column has no declared dimension; follow the data
+    return first_batch.schema if first_batch is not None else export_schema()
+
+async def next_batch(batches):
+    """Return the next record batch, or None when the export is exhausted."""
+    try:
+        return await batches.__anext__()
+    except StopAsyncIteration:
+        return None
+
+async def open_arrow_stream(conn, source='image_data', **filters):
+    """
+    Start an export and return an async iterator over its Arrow IPC stream, one chunk per record batch.
+
+    The source is checked and the first batch is read before returning, so
+    errors surface here rather than partway through a response.
+    """
+    dim = await check_source(conn, source)
+    batches = iter_record_batches(conn, source=source, **filters)
+    first_batch = await next_batch(batches)
+    schema = stream_schema(dim, first_batch)
+
+    async def chunks():
+        sink = _ChunkSink()
+        writer = pa.ipc.new_stream(sink, schema)
+        if first_batch is not None:
+            write_batch(writer, schema, first_batch)
+            yield sink.drain()
+            async for batch in batches:
+                write_batch(writer, schema, batch)
+                yield sink.drain()
+        writer.close()
+        yield sink.drain()
+
+    return chunks()
+
+async def run(args):
+    conn = await asyncpg.connect(DATABASE_URL)
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        await register_vector_codec(conn)
+        start = time.perf_counter()
+        dim = await check_source(conn, args.source)
+        batches = iter_record_batches(
+            conn, source=args.source, statuses=args.status, since=args.since,
+            until=args.until, locations=args.location, batch_size=args.batch_size
+        )
+        first_batch = await next_batch(batches)
+        schema = stream_schema(dim, first_batch)
+        writer = pa.ipc.new_stream(output, schema)
+        exported = 0
+        if first_batch is not None:
+            write_batch(writer, schema, first_batch)
+            exported += first_batch.num_rows
+            async for batch in batches:
+                write_batch(writer, schema, batch)
+                exported += batch.num_rows
+                logging.info(f"Exported {exported} rows ({exported / (time.perf_counter() - start):.0f} rows/s)")
+        writer.close()
+        elapsed = time.perf_counter() - start
+        logging.info(f"Exported {exported} rows in {elapsed:.2f}s ({exported / elapsed:.0f} rows/s)")
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+        await conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export image embeddings and metadata as an Arrow IPC stream.")
+    parser.add_argument("output", help="Output file ('-' for stdout, /dev/null to benchmark)")
+    parser.add_argument("--source", default='image_data', choices=list(EXPORT_SOURCES), help="Table or view to export from")
+    parser.add_argument("--status", nargs='+', default=['completed'], help="Only rows with these statuses")
+    parser.add_argument("--since", type=parse_timestamp, help="Only rows captured at or after this ISO timestamp")
+    parser.add_argument("--until", type=parse_timestamp, help="Only rows captured before this ISO timestamp")
+    parser.add_argument("--location", nargs='+', help="Only rows from these locations")
+    parser.add_argument("--batch-size", type=int, default=10000, help="Rows per cursor fetch and record batch")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+-- add_retention.sql
+
+-- 记录原图被重新压缩为归档格式的时间
+ALTER TABLE image_data ADD COLUMN IF NOT EXISTS archived_at TIMESTAMPTZ;
+
+-- 创建归档表，结构与 image_data 相同，分区与 image_data 的分区一一对应
+CREATE TABLE IF NOT EXISTS image_data_archive (
+    LIKE image_data INCLUDING DEFAULTS,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+-- 创建归档表索引
+CREATE INDEX IF NOT EXISTS idx_archive_image_id ON image_data_archive (image_id);
+CREATE INDEX IF NOT EXISTS idx_archive_timestamp ON image_data_archive (timestamp);
+CREATE INDEX IF NOT EXISTS idx_archive_location ON image_data_archive (location);
+CREATE INDEX IF NOT EXISTS idx_archive_vector ON image_data_archive USING ivfflat (vector vector_l2_ops);
+
+-- 创建视图，同时查询在线数据和归档数据
+CREATE OR REPLACE VIEW image_data_all AS
+    SELECT id, image_id, s3_url, status, timestamp, location, vector, created_at, updated_at, archived_at, FALSE AS is_archived
+    FROM image_data
+    UNION ALL
+    SELECT id, image_id, s3_url, status, timestamp, location, vector, created_at, updated_at, archived_at, TRUE AS is_archived
+    FROM image_data_archive;